@@ -1,46 +1,84 @@
 import asyncio
+import atexit
 import logging
+import logging.handlers
+import queue
 import random
+from dataclasses import dataclass
 from pathlib import Path
 from typing import Awaitable, Callable
 
 import can
 import cantools
 
-SubscriberCallback = Callable[[can.Message], Awaitable[None]]
+SubscriberCallback = Callable[[can.Message], Awaitable[None] | None]
+FrameDecoder = Callable[[bytes | bytearray], dict]
+FrameDecoders = dict[int, FrameDecoder]
 
-CAN_BUS_BITRATE = 500000
-CAN_DBC_FILE = Path('dbc/model3/Model3CAN.dbc')
 
-VEHICLE_BUS_CHANNEL = 'can0'
+@dataclass(frozen=True)
+class Config:
+	can_bus_bitrate: int = 500000
+	can_dbc_file: Path = Path('dbc/model3/Model3CAN.dbc')
 
-VOLUME_FLICK_INTERVAL = 10.0
-VOLUME_FLICK_JITTER = 2
+	vehicle_bus_channel: str = 'can0'
+	# Upper bound on frames handled per socket wake-up before the reader yields back to the event loop
+	can_recv_batch_size: int = 64
 
-SIGNALS_TO_PRINT = {
-	0x321: ['VCFRONT_brakeFluidLevel', 'VCFRONT_coolantLevel'],
-	0x3d8: ['Elevation3D8'],
+	volume_flick_interval: float = 10.0
+	volume_flick_jitter: float = 2
+
+	log_all_frames: bool = True
+
+
+IGNORED_IDS: frozenset[int] = frozenset()
+
+SIGNALS_TO_PRINT: dict[int, tuple[str, ...]] = {
+	0x321: ('VCFRONT_brakeFluidLevel', 'VCFRONT_coolantLevel'),
+	0x3d8: ('Elevation3D8',),
 }
 
 
+class LocalQueueHandler(logging.handlers.QueueHandler):
+	# The stock prepare() formats and copies every record on the calling thread (the event loop). The queue
+	# never leaves this process, so hand the record over untouched and let the listener thread format it.
+	def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+		return record
+
+
+# Loggers only enqueue records; the listener thread does the formatting and I/O off the event loop
+log_queue: queue.Queue[logging.LogRecord] = queue.Queue(-1)
+log_output_handlers: list[logging.Handler] = []
+
+
 def configure_logger(name: str, level: int, file: Path = None, formatter: logging.Formatter = None,
                      propagate=False) -> logging.Logger:
 	logger = logging.getLogger(name)
+	# Already configured (e.g. module re-imported); adding another handler would duplicate every record
+	if logger.handlers:
+		return logger
+
 	logger.setLevel(level)
 	logger.propagate = propagate
 
 	if file:
 		file.unlink(missing_ok=True)
-		file_handler = logging.FileHandler(file)
+		file_handler = logging.FileHandler(file, delay=True)
 		file_handler.setLevel(level)
 		file_handler.setFormatter(formatter)
-		logger.addHandler(file_handler)
+		# Batch disk writes; anything at WARNING or above is flushed immediately
+		output_handler = logging.handlers.MemoryHandler(1024, flushLevel=logging.WARNING, target=file_handler)
+		output_handler.setLevel(level)
 
 	else:
-		console_handler = logging.StreamHandler()
-		console_handler.setLevel(level)
-		console_handler.setFormatter(formatter)
-		logger.addHandler(console_handler)
+		output_handler = logging.StreamHandler()
+		output_handler.setLevel(level)
+		output_handler.setFormatter(formatter)
+
+	# The listener is shared, so each output handler only accepts records from its own logger
+	output_handler.addFilter(logging.Filter(name))
+	log_output_handlers.append(output_handler)
+	logger.addHandler(LocalQueueHandler(log_queue))
 
 	return logger
 
@@ -50,35 +88,69 @@ logging.formatter = common_formatter
 can_logger = configure_logger("CAN", logging.DEBUG, file=Path("can.log"), formatter=common_formatter)
 flick_logger = configure_logger("Flick", logging.DEBUG, formatter=common_formatter)
 signal_logger = configure_logger("Signal", logging.DEBUG, formatter=common_formatter)
+# On a re-import the loggers are already wired to the running listener, so don't start another
+if log_output_handlers:
+	log_listener = logging.handlers.QueueListener(log_queue, *log_output_handlers, respect_handler_level=True)
+	log_listener.start()
+	atexit.register(log_listener.stop)
 
 
 class CANBusSubscriber:
 	def __init__(self) -> None:
 		self.subscribers: dict[int | None, list[SubscriberCallback]] = {}
+		# Read-only snapshots used by notify_subscribers; rebuilt whenever subscribers change
+		self._global_dispatch: tuple[SubscriberCallback, ...] = ()
+		self._id_dispatch: dict[int, tuple[SubscriberCallback, ...]] = {}
 
 	def subscribe(self, callback: SubscriberCallback, can_id: int = None) -> None:
 		if can_id not in self.subscribers:
 			self.subscribers[can_id] = []
 		if callback not in self.subscribers[can_id]:
 			self.subscribers[can_id].append(callback)
+			self._freeze_dispatch()
 
 	def unsubscribe(self, callback: SubscriberCallback, can_id: int = None) -> None:
-		if callback in self.subscribers and callback in self.subscribers[can_id]:
+		if can_id in self.subscribers and callback in self.subscribers[can_id]:
 			self.subscribers[can_id].remove(callback)
+			self._freeze_dispatch()
 
-	async def notify_subscribers(self, message: can.Message) -> None:
-		for subscriber in self.subscribers.get(None, []):
-			await subscriber(message)
-
-		for subscriber in self.subscribers.get(message.arbitration_id, []):
-			await subscriber(message)
+	def _freeze_dispatch(self) -> None:
+		# Swapped in with plain assignments; the event loop is single threaded, so no lock is needed
+		self._global_dispatch = tuple(self.subscribers.get(None, ()))
+		self._id_dispatch = {can_id: tuple(callbacks) for can_id, callbacks in self.subscribers.items()
+		                     if can_id is not None and callbacks}
 
-async def read_can_messages(bus: can.BusABC, subscriber: CANBusSubscriber):
-	while True:
-		message = bus.recv()
-		if message:
-			await subscriber.notify_subscribers(message)
-		await asyncio.sleep(0.000001)
+	async def notify_subscribers(self, message: can.Message) -> None:
+		# Callbacks may be plain functions; only await the ones that hand back an awaitable
+		for subscriber in self._global_dispatch:
+			result = subscriber(message)
+			if result is not None:
+				await result
+
+		for subscriber in self._id_dispatch.get(message.arbitration_id, ()):
+			result = subscriber(message)
+			if result is not None:
+				await result
+
+
+async def read_can_messages(bus: can.BusABC, subscriber: CANBusSubscriber, batch_size: int):
+	loop = asyncio.get_running_loop()
+	frames_ready = asyncio.Event()
+	loop.add_reader(bus.fileno(), frames_ready.set)
+	try:
+		while True:
+			await frames_ready.wait()
+			frames_ready.clear()
+			# Drain a bounded batch, then yield so flick_volume isn't starved under sustained traffic.
+			# add_reader is level-triggered, so anything left on the socket wakes us again right away.
+			for _ in range(batch_size):
+				message = bus.recv(timeout=0)
+				if message is None:
+					break
+				await subscriber.notify_subscribers(message)
+			await asyncio.sleep(0)
+	finally:
+		loop.remove_reader(bus.fileno())
 
 
 def create_signal_dict(message, specified_signals, default_value=0) -> dict[str, int]:
@@ -99,78 +171,124 @@ def create_signal_dict(message, specified_signals, default_value=0) -> dict[str,
 	return signals
 
 
-async def flick_volume(bus: can.BusABC, dbc: cantools.db.Database) -> None:
+async def flick_volume(bus: can.BusABC, dbc: cantools.db.Database, config: Config) -> None:
 	volume_message = dbc.get_message_by_frame_id(0x3c2)
 	signals = create_signal_dict(volume_message, {'VCLEFT_swcLeftScrollTicks': -1})
+
+	# The flick payloads never change, so encode them once up front
+	encoded_minus = volume_message.encode(signals)
+	signals['VCLEFT_swcLeftScrollTicks'] = 1
+	encoded_plus = volume_message.encode(signals)
+
+	# One frame is reused for every flick; its payload is overwritten in place
+	can_frame = can.Message(arbitration_id=0x3c2, data=bytearray(len(encoded_minus)), is_extended_id=False)
+
+	# Schedule against absolute deadlines so sleep overshoot doesn't accumulate into drift
+	loop = asyncio.get_running_loop()
+	next_flick = loop.time()
 	while True:
-		jitter = (random.randint(0, 2000 * VOLUME_FLICK_JITTER) / 1000) - VOLUME_FLICK_JITTER
-		interval = VOLUME_FLICK_INTERVAL + jitter
-		flick_logger.info(f"Flicking volume in {interval:.4f} seconds")
-		await asyncio.sleep(interval)
+		jitter = random.uniform(-config.volume_flick_jitter, config.volume_flick_jitter)
+		interval = config.volume_flick_interval + jitter
+		now = loop.time()
+		# Only a full missed interval counts as late; then restart from now instead of bursting the missed flicks
+		if now - next_flick > interval:
+			next_flick = now
+		next_flick += interval
+		delay = max(0.0, next_flick - now)
+		flick_logger.info("Flicking volume in %.4f seconds", delay)
+		await asyncio.sleep(delay)
 
 		flick_logger.info("Flicking volume")
 
-		signals['VCLEFT_swcLeftScrollTicks'] = -1
-		encoded_data = volume_message.encode(signals)
-		can_frame = can.Message(arbitration_id=0x3c2, data=bytearray(encoded_data), is_extended_id=False)
+		can_frame.data[:] = encoded_minus
 		bus.send(can_frame)
 		await asyncio.sleep(0.01)
 
-		signals['VCLEFT_swcLeftScrollTicks'] = 1
-		encoded_data = volume_message.encode(signals)
-		can_frame.data = bytearray(encoded_data)
+		can_frame.data[:] = encoded_plus
 		bus.send(can_frame)
 
 
-async def log_frames(dbc: cantools.db.Database, message: can.Message) -> None:
-	try:
-		decoded_message = dbc.decode_message(message.arbitration_id, message.data)
-		can_logger.info(f"Received message: {decoded_message}")
-	except cantools.db.errors.DecodeError as e:
-		can_logger.debug(f"Decode error: {e}")
-		can_logger.debug(
-			f"Raw message: ID={message.arbitration_id}, Data={message.data.hex()}, Timestamp={message.timestamp}")
-		return
+def build_frame_decoders(dbc: cantools.db.Database, ignored_ids: frozenset[int] = frozenset()) -> FrameDecoders:
+	return {message.frame_id: message.decode for message in dbc.messages if message.frame_id not in ignored_ids}
 
-	except (KeyError, ValueError):
-		can_logger.debug(f"Received unknown message: {message}")
 
+def log_frames(decoders: FrameDecoders, ignored_ids: frozenset[int], message: can.Message) -> None:
+	decode = decoders.get(message.arbitration_id)
+	if decode is None:
+		if message.arbitration_id not in ignored_ids:
+			can_logger.debug("Received unknown message: %s", message)
+		return
 
-async def print_signal(dbc: cantools.db.Database, message: can.Message, can_id: int, signal_name: str):
-	if message.arbitration_id == can_id:
-		try:
-			decoded_message = dbc.decode_message(message.arbitration_id, message.data)
-			signal_value = decoded_message.get(signal_name, "Unknown")
-			print(f"{signal_name}: {signal_value}")
-		except cantools.db.errors.DecodeError as e:
-			print(f"Decode error for ID {can_id}: {e}")
-		except KeyError:
-			print(f"Signal {signal_name} not found in message ID {can_id}")
+	try:
+		decoded_message = decode(message.data)
+		can_logger.info("Received message: %s", decoded_message)
+	except (cantools.db.errors.DecodeError, ValueError) as e:
+		if can_logger.isEnabledFor(logging.DEBUG):
+			can_logger.debug("Decode error: %s", e)
+			can_logger.debug("Raw message: ID=%s, Data=%s, Timestamp=%s",
+			                 message.arbitration_id, message.data.hex(), message.timestamp)
 
 
-async def main() -> None:
-	dbc = cantools.db.can.database.Database()
-	dbc.add_dbc_file(CAN_DBC_FILE)
-	vehicle_bus = can.interface.Bus(bustype='socketcan', channel=VEHICLE_BUS_CHANNEL, bitrate=CAN_BUS_BITRATE)
+def print_signals(decode: FrameDecoder, message: can.Message, can_id: int,
+                  signal_names: tuple[str, ...]) -> None:
+	try:
+		decoded_message = decode(message.data)
+	except cantools.db.errors.DecodeError as e:
+		signal_logger.warning("Decode error for ID %s: %s", can_id, e)
+		return
 
-	subscriber = CANBusSubscriber()
-	subscriber.subscribe(lambda message: log_frames(dbc, message))
-	for frame_id, signal_names in SIGNALS_TO_PRINT.items():
-		for signal_name in signal_names:
-			def make_callback(call_frame_id: int, call_signal_name: str) -> SubscriberCallback:
-				async def callback(message: can.Message) -> None:
-					await print_signal(dbc, message, call_frame_id, call_signal_name)
+	for signal_name in signal_names:
+		signal_value = decoded_message.get(signal_name, "Unknown")
+		signal_logger.info("%s: %s", signal_name, signal_value)
 
-				return callback
 
-			subscriber_callback = make_callback(frame_id, signal_name)
-			subscriber.subscribe(subscriber_callback, frame_id)
+async def main(config: Config = Config()) -> None:
+	dbc = cantools.db.can.database.Database()
+	dbc.add_dbc_file(config.can_dbc_file)
+	vehicle_bus = can.interface.Bus(bustype='socketcan', channel=config.vehicle_bus_channel,
+	                                bitrate=config.can_bus_bitrate, receive_own_messages=False)
+	if not config.log_all_frames:
+		# Let the kernel drop every frame we don't print. This is only possible without full-frame
+		# logging, since log_frames needs to see the whole bus on the same socket.
+		vehicle_bus.set_filters([{"can_id": frame_id, "can_mask": 0x7FF, "extended": False}
+		                         for frame_id in SIGNALS_TO_PRINT])
+
+	decoders = build_frame_decoders(dbc)
 
-	flick_volume_task = asyncio.create_task(flick_volume(vehicle_bus, dbc))
-	read_can_messages_task = asyncio.create_task(read_can_messages(vehicle_bus, subscriber))
+	subscriber = CANBusSubscriber()
+	if config.log_all_frames:
+		# Ignored IDs are left out of the logging table, so the one lookup per frame also filters them
+		log_decoders = build_frame_decoders(dbc, IGNORED_IDS)
+		subscriber.subscribe(lambda message: log_frames(log_decoders, IGNORED_IDS, message))
+	# One callback per frame, so each frame is decoded once no matter how many of its signals are printed
+	signal_dispatch = {frame_id: (decoders.get(frame_id), signal_names)
+	                   for frame_id, signal_names in SIGNALS_TO_PRINT.items()}
+	for frame_id, (decode, signal_names) in signal_dispatch.items():
+		if decode is None:
+			signal_logger.warning("Message ID %s not found in %s", frame_id, config.can_dbc_file)
+			continue
+
+		def make_callback(call_decode: FrameDecoder, call_frame_id: int,
+		                  call_signal_names: tuple[str, ...]) -> SubscriberCallback:
+			def callback(message: can.Message) -> None:
+				print_signals(call_decode, message, call_frame_id, call_signal_names)
+
+			return callback
+
+		subscriber.subscribe(make_callback(decode, frame_id, signal_names), can_id=frame_id)
+
+	flick_volume_task = asyncio.create_task(flick_volume(vehicle_bus, dbc, config))
+	read_can_messages_task = asyncio.create_task(read_can_messages(vehicle_bus, subscriber, config.can_recv_batch_size))
 
 	await asyncio.gather(flick_volume_task, read_can_messages_task, return_exceptions=True)
 
 
 if __name__ == '__main__':
+	try:
+		import uvloop
+
+		asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+	except ImportError:
+		pass
+
 	asyncio.run(main())